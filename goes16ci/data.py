@@ -8,9 +8,23 @@ import logging
 import s3fs as s3
 import os
 
+def unpack_radiance_counts(counts, scale_factor, add_offset, fill_value):
+    """
+    Convert packed int16 ABI radiance counts with dimensions (patch, band, y, x) to float32 radiance.
+    Fill values are set to NaN.
+    """
+    band_shape = (1, -1, 1, 1)
+    radiance = counts.astype(np.float32) * scale_factor.reshape(band_shape) + add_offset.reshape(band_shape)
+    radiance[counts == fill_value.reshape(band_shape)] = np.nan
+    return radiance
+
+
 def load_single_data_file(filename, image_variable="abi", count_variable="flash_counts", time_variable="time"):
     ds = xr.open_dataset(filename)
     imagery = ds.variables[image_variable].values
+    if "rad_scale_factor" in ds.variables:
+        imagery = unpack_radiance_counts(imagery, ds["rad_scale_factor"].values, ds["rad_add_offset"].values,
+                                         ds["rad_fill_value"].values)
     nan_indices = np.unique(np.where(np.isnan(imagery))[0])
     all_indices = np.arange(imagery.shape[0])
     valid_indices = all_indices[np.isin(all_indices, nan_indices, assume_unique=True, invert=True)]
@@ -1,12 +1,14 @@
 import pandas as pd
 import numpy as np
 from glob import glob
-from datetime import datetime
-from pyproj import Proj, transform
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from pyproj import Proj, Transformer
 from os.path import join, exists
-from os import makedirs
-from scipy.interpolate import RectBivariateSpline
+from os import makedirs, remove, replace
+from scipy.ndimage import map_coordinates
 import xarray as xr
+import netCDF4
 
 
 class GOES16ABI(object):
@@ -18,19 +20,30 @@ class GOES16ABI(object):
         bands (:class:`numpy.ndarray`): GOES-16 hyperspectral bands to load
         path (str): Path to top level of GOES-16 ABI directory.
         time_range_minutes (int): interval in number of minutes to search for file that matches input time
-        goes16_ds (`dict` of :class:`xarray.Dataset` objects): Datasets for each channel
+        goes16_ds (:class:`xarray.Dataset`): Undecoded variables of every channel concatenated along a band
+            dimension. All bands must share the same resolution.
 
     """
     def __init__(self, date, bands, path, time_range_minutes=5):
         self.date = pd.Timestamp(date)
         self.bands = np.array(bands, dtype=np.int32)
+        self._date_str = self.date.strftime("%Y%m%d")
         self.path = path
         self.time_range_minutes = time_range_minutes
-        self.goes16_ds = dict()
-        self.channel_files = []
-        for band in bands:
-            self.channel_files.append(self.goes16_abi_filename(band))
-            self.goes16_ds[band] = xr.open_dataset(self.channel_files[-1])
+        self.channel_files = [self.goes16_abi_filename(band) for band in self.bands]
+        # Bands are read one after another without dask: dask would route reads through a distributed client
+        # when one is active, and h5py serializes HDF5 calls, so threads would not overlap the reads either.
+        self.goes16_ds = xr.concat([_load_abi_band(channel_file) for channel_file in self.channel_files],
+                                   dim="band", data_vars="all", coords="minimal", compat="override", join="exact")
+        # Radiances stay packed as 16-bit integers and are only unpacked for the extracted patches.
+        self._rad = np.ascontiguousarray(self.goes16_ds["Rad"].values)
+        self._rad_attrs = [dict(self.goes16_ds["Rad"].attrs, scale_factor=scale_factor, add_offset=add_offset,
+                                _FillValue=fill_value)
+                           for scale_factor, add_offset, fill_value in
+                           zip(self.goes16_ds["rad_scale_factor"].values, self.goes16_ds["rad_add_offset"].values,
+                               self.goes16_ds["rad_fill_value"].values)]
+        self._planck = {planck_var: self.goes16_ds[planck_var].values
+                        for planck_var in ["planck_fk1", "planck_fk2", "planck_bc1", "planck_bc2"]}
         self.proj = self.goes16_projection()
         self.x = None
         self.y = None
@@ -39,7 +52,6 @@ class GOES16ABI(object):
         self.lon = None
         self.lat = None
         self.sat_coordinates()
-        self.lon_lat_coords()
 
     @staticmethod
     def abi_file_dates(files, file_date='e'):
@@ -58,9 +70,9 @@ class GOES16ABI(object):
         if file_date not in ['c', 's', 'e']:
             file_date = 'c'
         date_index = {"c": -1, "s": -3, "e": -2}
-        channel_dates = pd.DatetimeIndex(
-            [datetime.strptime(c_file[:-3].split("/")[-1].split("_")[date_index[file_date]][1:-1],
-                               "%Y%j%H%M%S") for c_file in files])
+        date_strs = np.array([c_file[:-3].split("/")[-1].split("_")[date_index[file_date]][1:-1]
+                              for c_file in files], dtype=str)
+        channel_dates = pd.DatetimeIndex(pd.to_datetime(date_strs, format="%Y%j%H%M%S"))
         return channel_dates
 
     def goes16_abi_filename(self, channel):
@@ -77,21 +89,20 @@ class GOES16ABI(object):
         Returns:
             str: full path to requested GOES-16 file
         """
-        pd_date = pd.Timestamp(self.date)
-        #print("pd_date ",pd_date)
-        channel_files = np.array(sorted(glob(join(self.path, pd_date.strftime("%Y%m%d"),
-                                         f"OR_ABI-L1b-RadC-M*C{channel:02d}_G16_*.nc"))))
-        #print("channel_files",channel_files)
-        channel_dates = self.abi_file_dates(channel_files)
-        #print("channel_dates",channel_dates)
-        date_diffs = np.abs(channel_dates - pd_date)
-        #print("Date_diffs",date_diffs)
-        file_index = np.where(date_diffs <= pd.Timedelta(minutes=self.time_range_minutes))[0]
-        #print("File_index",file_index)
-        if len(file_index) == 0:
-            raise FileNotFoundError('No GOES-16 files within {0:d} minutes of '.format(self.time_range_minutes) + pd_date.strftime("%Y-%m-%d %H:%M:%S" + ". Nearest file is within {0}".format(date_diffs.total_seconds().values.min() / 60)))
+        channel_files, channel_dates = _goes16_channel_files(self.path, self._date_str, int(channel))
+        if channel_files.size == 0:
+            raise FileNotFoundError('No GOES-16 files for channel {0:d} in '.format(int(channel)) +
+                                    join(self.path, self._date_str))
+        # channel_dates is sorted, so the nearest file is on one side of the insertion point. Convert to
+        # nanoseconds explicitly since newer pandas may parse the dates at a coarser unit.
+        date_ns = channel_dates.values.astype("datetime64[ns]").view(np.int64)
+        insert_index = np.searchsorted(date_ns, self.date.value)
+        candidates = np.clip([insert_index - 1, insert_index], 0, date_ns.size - 1)
+        date_diffs = np.abs(date_ns[candidates] - self.date.value)
+        if date_diffs.min() > pd.Timedelta(minutes=self.time_range_minutes).value:
+            raise FileNotFoundError('No GOES-16 files within {0:d} minutes of '.format(self.time_range_minutes) + self.date.strftime("%Y-%m-%d %H:%M:%S" + ". Nearest file is within {0}".format(date_diffs.min() / pd.Timedelta(minutes=1).value)))
         else:
-            filename = channel_files[np.argmin(date_diffs)]
+            filename = channel_files[candidates[np.argmin(date_diffs)]]
         return filename
 
     def goes16_projection(self):
@@ -101,7 +112,7 @@ class GOES16ABI(object):
         `PROJ <https://proj4.org/operations/projections/geos.html>`_ documentation.
 
         """
-        goes16_ds = self.goes16_ds[self.bands.min()]
+        goes16_ds = self.goes16_ds
         proj_dict = dict(proj="geos",
                          h=goes16_ds["goes_imager_projection"].attrs["perspective_point_height"],
                          lon_0=goes16_ds["goes_imager_projection"].attrs["longitude_of_projection_origin"],
@@ -111,22 +122,65 @@ class GOES16ABI(object):
     def sat_coordinates(self):
         """
         Calculate the geostationary projection x and y coordinates in m for each
-        pixel in the image.
+        pixel in the image. The gridded coordinates are stored as a row vector (x_g)
+        and a column vector (y_g) that broadcast against each other to the full image shape.
         """
-        goes16_ds = self.goes16_ds[self.bands.min()]
-        sat_height = goes16_ds["goes_imager_projection"].attrs["perspective_point_height"]
-        self.x = goes16_ds["x"].values * sat_height
-        self.y = goes16_ds["y"].values * sat_height
-        self.x_g, self.y_g = np.meshgrid(self.x, self.y)
+        goes16_ds = self.goes16_ds
+        sat_height = np.float32(goes16_ds["goes_imager_projection"].attrs["perspective_point_height"])
+        self.x = _unpack(goes16_ds["x"].values, goes16_ds["x"].attrs) * sat_height
+        self.y = _unpack(goes16_ds["y"].values, goes16_ds["y"].attrs) * sat_height
+        self.x_g = self.x[np.newaxis, :]
+        self.y_g = self.y[:, np.newaxis]
+        # GOES y decreases from north to south. Keep increasing views of both axes for binary searches.
+        self._x_desc = self.x[0] > self.x[-1]
+        self._y_desc = self.y[0] > self.y[-1]
+        self._x_search = self.x[::-1] if self._x_desc else self.x
+        self._y_search = self.y[::-1] if self._y_desc else self.y
 
     def lon_lat_coords(self):
         """
         Calculate longitude and latitude coordinates for each point in the GOES-16
-        image.
+        image. Not called on construction; :meth:`extract_image_patches` projects only the patch pixels.
         """
-        self.lon, self.lat = self.proj(self.x_g, self.y_g, inverse=True)
-        self.lon[self.lon > 1e10] = np.nan
-        self.lat[self.lat > 1e10] = np.nan
+        self.lon, self.lat = self._xy_to_lonlat(self.x_g, self.y_g)
+
+    def _xy_to_lonlat(self, x_g, y_g):
+        """
+        Invert the geostationary projection for broadcastable x and y coordinate arrays. Points off
+        the Earth's disk are set to NaN.
+
+        Args:
+            x_g (:class:`numpy.ndarray`): x coordinates in m
+            y_g (:class:`numpy.ndarray`): y coordinates in m
+        Returns:
+            lon, lat: arrays of longitude and latitude with the broadcast shape of x_g and y_g
+        """
+        # pyproj requires equal-sized inputs, so expand the broadcast views only for the projection call.
+        x_g, y_g = np.broadcast_arrays(x_g, y_g)
+        lon, lat = self.proj(x_g, y_g, inverse=True)
+        # Points off the disk come back as inf in both coordinates, so one mask covers lon and lat.
+        off_disk = lon > 1e10
+        lon[off_disk] = np.nan
+        lat[off_disk] = np.nan
+        return lon, lat
+
+    def _nearest_pixels(self, center_x, center_y):
+        """
+        Find the row and column of the pixels closest to a set of projected coordinates.
+
+        Args:
+            center_x (:class:`numpy.ndarray`): x coordinates in m
+            center_y (:class:`numpy.ndarray`): y coordinates in m
+        Returns:
+            rows, cols: index arrays with the shape of center_x
+        """
+        rows = _nearest_index(self._y_search, center_y)
+        cols = _nearest_index(self._x_search, center_x)
+        if self._y_desc:
+            rows = self.y.size - 1 - rows
+        if self._x_desc:
+            cols = self.x.size - 1 - cols
+        return rows, cols
 
     def extract_image_patch(self, center_lon, center_lat, x_size_pixels, y_size_pixels, bt=True):
         """
@@ -141,37 +195,172 @@ class GOES16ABI(object):
         Returns:
 
         """
-        center_x, center_y = self.proj(center_lon, center_lat)
-        center_row = np.argmin(np.abs(self.y - center_y))
-        center_col = np.argmin(np.abs(self.x - center_x))
-        row_slice = slice(int(center_row - y_size_pixels // 2), int(center_row + y_size_pixels // 2))
-        col_slice = slice(int(center_col - x_size_pixels // 2), int(center_col + x_size_pixels // 2))
-        patch = np.zeros((1, self.bands.size, y_size_pixels, x_size_pixels), dtype=np.float32)
-        for b, band in enumerate(self.bands):
-            if bt:
-                patch[0, b, :, :] = (self.goes16_ds[band]["planck_fk2"].values /
-                                     np.log(self.goes16_ds[band]["planck_fk1"].values /
-                                            self.goes16_ds[band]["Rad"][row_slice, col_slice].values + 1) -
-                                     self.goes16_ds[band]["planck_bc1"].values) / self.goes16_ds[band]["planck_bc2"].values
-            else:
-                patch[0, b, :, :] = self.goes16_ds[band]["Rad"][row_slice, col_slice].values
-        lons = self.lon[row_slice, col_slice]
-        lats = self.lat[row_slice, col_slice]
-        return patch, lons, lats
+        patches, lons, lats = self.extract_image_patches(np.array([center_lon]), np.array([center_lat]),
+                                                         x_size_pixels, y_size_pixels, bt=bt)
+        return patches, lons[0], lats[0]
+
+    def extract_image_patches(self, center_lons, center_lats, x_size_pixels, y_size_pixels, bt=True, raw=False):
+        """
+        Extract subsets of a satellite image around a set of locations. All centers are projected
+        in a single call, and the nearest pixels are found with a binary search on the monotonic x and y axes.
+
+        Args:
+            center_lons (:class:`numpy.ndarray`): longitudes of the center pixel of each patch
+            center_lats (:class:`numpy.ndarray`): latitudes of the center pixel of each patch
+            x_size_pixels (int): number of pixels in the west-east direction
+            y_size_pixels (int): number of pixels in the south-north direction
+            bt (bool): Convert to brightness temperature during extraction
+            raw (bool): Return the packed int16 radiance counts without applying scale_factor and add_offset.
+                See :meth:`rad_packing` for the packing parameters. Cannot be combined with bt.
+        Returns:
+            patches (sample, band, y, x), lons (sample, y, x), lats (sample, y, x)
+        """
+        if raw and bt:
+            raise ValueError("Brightness temperature cannot be calculated for raw radiance counts.")
+        center_x, center_y = self.proj(np.asarray(center_lons, dtype=np.float64),
+                                       np.asarray(center_lats, dtype=np.float64))
+        center_rows, center_cols = self._nearest_pixels(center_x, center_y)
+        patch_rows = center_rows[:, np.newaxis] + (np.arange(y_size_pixels) - y_size_pixels // 2)
+        patch_cols = center_cols[:, np.newaxis] + (np.arange(x_size_pixels) - x_size_pixels // 2)
+        if patch_rows.size > 0 and (patch_rows.min() < 0 or patch_rows.max() >= self.y.size or
+                                    patch_cols.min() < 0 or patch_cols.max() >= self.x.size):
+            raise ValueError("Patch extends beyond the edge of the GOES-16 image.")
+        # Gather every band and sample in one fancy-indexing call: (band, sample, y, x) -> (sample, band, y, x)
+        rad_patches = np.moveaxis(self._rad[:, patch_rows[:, :, np.newaxis], patch_cols[:, np.newaxis, :]], 0, 1)
+        if raw:
+            patches = np.ascontiguousarray(rad_patches, dtype=np.int16)
+        else:
+            patches = np.zeros(rad_patches.shape, dtype=np.float32)
+            for b in range(self.bands.size):
+                patches[:, b] = _unpack(rad_patches[:, b], self._rad_attrs[b])
+                if bt:
+                    patches[:, b] = (self._planck["planck_fk2"][b] /
+                                     np.log(self._planck["planck_fk1"][b] / patches[:, b] + 1) -
+                                     self._planck["planck_bc1"][b]) / self._planck["planck_bc2"][b]
+        patch_x = self.x[patch_cols]
+        patch_y = self.y[patch_rows]
+        lons, lats = self._xy_to_lonlat(patch_x[:, np.newaxis, :], patch_y[:, :, np.newaxis])
+        return patches, lons, lats
+
+    def rad_packing(self):
+        """
+        Get the parameters used to pack the radiance of each band into 16-bit integers.
+
+        Returns:
+            scale_factor, add_offset, fill_value: arrays with one value per band
+        """
+        scale_factor = np.array([attrs["scale_factor"] for attrs in self._rad_attrs], dtype=np.float32)
+        add_offset = np.array([attrs["add_offset"] for attrs in self._rad_attrs], dtype=np.float32)
+        fill_value = np.array([attrs["_FillValue"] for attrs in self._rad_attrs], dtype=np.int16)
+        return scale_factor, add_offset, fill_value
 
     def close(self):
-        for band in self.bands:
-            self.goes16_ds[band].close()
-            del self.goes16_ds[band]
+        self.goes16_ds.close()
+        self._rad = None
+
+
+def _load_abi_band(channel_file):
+    """
+    Read the variables used by :class:`GOES16ABI` from a single GOES-16 ABI band file into memory.
+
+    Args:
+        channel_file (str): Path to the ABI L1b file
+    Returns:
+        :class:`xarray.Dataset`
+    """
+    with xr.open_dataset(channel_file, engine="h5netcdf", decode_cf=False, mask_and_scale=False) as channel_ds:
+        return _abi_band_variables(channel_ds).load()
+
+
+def _abi_band_variables(ds):
+    """
+    Select the variables of a single GOES-16 ABI band file used by :class:`GOES16ABI`. The Rad packing
+    attributes differ between bands, so they are copied into scalar variables that survive concatenation
+    along the band dimension.
+
+    Args:
+        ds (:class:`xarray.Dataset`): Undecoded ABI L1b dataset for one band
+    Returns:
+        :class:`xarray.Dataset`
+    """
+    band_ds = ds[["Rad", "goes_imager_projection", "planck_fk1", "planck_fk2", "planck_bc1", "planck_bc2"]]
+    rad_attrs = ds["Rad"].attrs
+    return band_ds.assign(rad_scale_factor=rad_attrs["scale_factor"], rad_add_offset=rad_attrs["add_offset"],
+                          rad_fill_value=rad_attrs["_FillValue"])
+
+
+def _unpack(packed, attrs, dtype=np.float32):
+    """
+    Apply the CF packing attributes (_Unsigned, scale_factor, add_offset, _FillValue) of a netCDF variable
+    opened with decode_cf=False. Fill values are set to NaN.
+
+    Args:
+        packed (:class:`numpy.ndarray`): packed values
+        attrs (dict): attributes of the packed variable
+        dtype: floating point type of the unpacked array
+    Returns:
+        :class:`numpy.ndarray`: unpacked values
+    """
+    if "_FillValue" in attrs:
+        is_fill = packed == attrs["_FillValue"]
+    else:
+        is_fill = None
+    if attrs.get("_Unsigned", "false") == "true":
+        packed = packed.view(packed.dtype.str.replace("i", "u"))
+    values = packed.astype(dtype)
+    if "scale_factor" in attrs:
+        values *= attrs["scale_factor"]
+    if "add_offset" in attrs:
+        values += attrs["add_offset"]
+    if is_fill is not None:
+        values[is_fill] = np.nan
+    return values
+
+
+def _nearest_index(axis, values):
+    """
+    Find the index of the closest point in a monotonically increasing 1D coordinate axis for each value.
+
+    Args:
+        axis (:class:`numpy.ndarray`): monotonically increasing coordinates
+        values (:class:`numpy.ndarray`): coordinates to look up
+    Returns:
+        :class:`numpy.ndarray`: index of the nearest axis point for each value
+    """
+    values = np.asarray(values)
+    right = np.clip(np.searchsorted(axis, values), 1, axis.size - 1)
+    left = right - 1
+    return np.where(np.abs(values - axis[left]) <= np.abs(axis[right] - values), left, right)
+
+
+@lru_cache(maxsize=256)
+def _goes16_channel_files(path, date_str, channel):
+    """
+    List the GOES-16 ABI files for one channel in a daily directory along with their end dates, sorted by
+    end date. Results are cached since every timestep and band within a day searches the same directory.
+
+    Args:
+        path (str): Path to top level of GOES-16 ABI directory.
+        date_str (str): Date of the daily directory in %Y%m%d format.
+        channel (int): GOES-16 ABI channel number.
+    Returns:
+        channel_files (:class:`numpy.ndarray`), channel_dates (:class:`pandas.DatetimeIndex`)
+    """
+    channel_files = np.array(sorted(glob(join(path, date_str, f"OR_ABI-L1b-RadC-M*C{channel:02d}_G16_*.nc"))))
+    channel_dates = GOES16ABI.abi_file_dates(channel_files)
+    # Filenames sort by scan mode before date, so order by date explicitly for binary searches.
+    date_order = np.argsort(channel_dates.asi8, kind="stable")
+    return channel_files[date_order], channel_dates[date_order]
 
 
 def extract_abi_patches(abi_path, patch_path, glm_grid_path, glm_file_date, bands,
                         lead_time, patch_x_length_pixels, patch_y_length_pixels, samples_per_time,
                         glm_file_freq="1D", max_pos_sample_ratio=0.5, glm_date_format="%Y%m%dT%H%M%S",
-                        time_range_minutes=4, bt=False):
+                        time_range_minutes=4, bt=False, n_workers=1, seed=None, raw_counts=False):
     """
     For a given set of gridded GLM counts, sample from the grids at each time step and extract ABI
-    patches centered on the lightning grid cell.
+    patches centered on the lightning grid cell. Time steps are independent and can be processed in
+    parallel with a pool of worker processes.
 
     Args:
         abi_path (str): path to GOES-16 ABI data
@@ -187,10 +376,18 @@ def extract_abi_patches(abi_path, patch_path, glm_grid_path, glm_file_date, band
         glm_date_format (str): How the GLM date is formatted
         time_range_minutes (int): Minutes before or after time in which GOES16 files are valid.
         bt (bool): Calculate brightness temperature instead of radiance
+        n_workers (int): Number of processes used to extract time steps. 1 runs serially in the calling process.
+        seed (int): Seed for the random sampling of grid points. Each time step draws from its own
+            independent stream, so results do not depend on n_workers.
+        raw_counts (bool): Store the packed int16 radiance counts instead of float32 radiance. The per-band
+            packing is written to the rad_scale_factor, rad_add_offset, and rad_fill_value variables.
+            Cannot be combined with bt.
 
     Returns:
 
     """
+    if raw_counts and bt:
+        raise ValueError("Brightness temperature cannot be stored as raw radiance counts.")
     start_date_str = glm_file_date.strftime(glm_date_format)
     end_date_str = (glm_file_date + pd.Timedelta(glm_file_freq)).strftime(glm_date_format)
     glm_grid_file = join(glm_grid_path, "glm_grid_s{0}_e{1}.nc".format(start_date_str, end_date_str))
@@ -201,93 +398,220 @@ def extract_abi_patches(abi_path, patch_path, glm_grid_path, glm_file_date, band
     lons = glm_ds["lon"]
     lats = glm_ds["lat"]
     counts = glm_ds["lightning_counts"]
-    patches = np.zeros((times.size * samples_per_time, bands.size, patch_y_length_pixels, patch_x_length_pixels),
-                       dtype=np.float32)
-    patch_lons = np.zeros((times.size * samples_per_time, patch_y_length_pixels, patch_x_length_pixels),
-                          dtype=np.float32)
-    patch_lats = np.zeros((times.size * samples_per_time, patch_y_length_pixels, patch_x_length_pixels),
-                          dtype=np.float32)
-    flash_counts = np.zeros((times.size * samples_per_time), dtype=np.int32)
-    grid_sample_indices = np.arange(lons.size, dtype=np.int32)
     max_pos_counts = int(samples_per_time * max_pos_sample_ratio)
-    is_valid = np.ones((times.size * samples_per_time), dtype=bool)
-    patch_times = []
-    for t, time in enumerate(times):
-        print(time, flush=True)
-        patch_time = time - pd.Timedelta(lead_time)
-        pos_count = np.count_nonzero(counts[t] > 0)
-        pos_sample_size = np.minimum(pos_count, max_pos_counts)
-        neg_sample_size = samples_per_time - pos_sample_size
-        count_grid = counts[t].values
-        if pos_sample_size > 0:
-            pos_time_samples = np.random.choice(grid_sample_indices[count_grid.ravel() > 0], size=pos_sample_size,
-                                                replace=False)
-            neg_time_samples = np.random.choice(grid_sample_indices[count_grid.ravel() == 0], size=neg_sample_size,
-                                                replace=False)
-            time_samples = np.concatenate([pos_time_samples, neg_time_samples])
-        else:
-            time_samples = np.random.choice(grid_sample_indices, size=samples_per_time, replace=False)
-        sample_rows, sample_cols = np.unravel_index(time_samples, lons.shape)
-        patch_times.extend([time] * samples_per_time)
-        try:
-            goes16_abi_timestep = GOES16ABI(patch_time, bands, abi_path, time_range_minutes=time_range_minutes)
-            for s in range(samples_per_time):
-                flash_counts[t * samples_per_time + s] = count_grid[sample_rows[s], sample_cols[s]]
-                patches[t * samples_per_time + s], \
-                    patch_lons[t * samples_per_time + s], \
-                    patch_lats[t * samples_per_time + s] = goes16_abi_timestep.extract_image_patch(lons[sample_rows[s], sample_cols[s]],
-                                                                                lats[sample_rows[s], sample_cols[s]],
-                                                                                patch_x_length_pixels,
-                                                                                patch_y_length_pixels,
-                                                                                bt=bt)
-            goes16_abi_timestep.close()
-            del goes16_abi_timestep
-        except FileNotFoundError as fnfe:
-            print(fnfe.args)
-            is_valid[t*samples_per_time: t * samples_per_time + samples_per_time] = False 
-    x_coords = np.arange(patch_x_length_pixels)
-    y_coords = np.arange(patch_y_length_pixels)
-    valid_patches = np.where(is_valid)[0]
-    patch_num = np.arange(valid_patches.shape[0])
-    glm_ds.close()
-    del glm_ds
-    patch_ds = xr.Dataset(data_vars={"abi": (("patch", "band", "y", "x"), patches[valid_patches]),
-                                     "time": (("patch", ), pd.DatetimeIndex(patch_times)[valid_patches]),
-                                     "lon": (("patch", "y", "x"), patch_lons[valid_patches]),
-                                     "lat": (("patch", "y", "x"), patch_lats[valid_patches]),
-                                     "flash_counts": (("patch", ), flash_counts[valid_patches])},
-                          coords={"patch": patch_num,
-                                  "y": y_coords, "x": x_coords, "band": bands})
+    time_seeds = np.random.SeedSequence(seed).spawn(times.size)
+    extract_timestep = partial(_extract_timestep_patches, lons=lons.values, lats=lats.values, bands=bands,
+                               abi_path=abi_path, lead_time=lead_time,
+                               patch_x_length_pixels=patch_x_length_pixels,
+                               patch_y_length_pixels=patch_y_length_pixels,
+                               samples_per_time=samples_per_time, max_pos_counts=max_pos_counts,
+                               time_range_minutes=time_range_minutes, bt=bt, raw=raw_counts)
+    # Read every time step of the counts at once rather than indexing the DataArray per time step.
+    count_grids = counts.values
     out_file = join(patch_path, "abi_patches_{0}.nc".format(glm_file_date.strftime(glm_date_format)))
     if not exists(patch_path):
         makedirs(patch_path)
-    patch_ds.to_netcdf(out_file,
-                       engine="netcdf4",
-                       encoding={"abi": {"zlib": True}, "lon": {"zlib": True}, "lat": {"zlib": True},
-                                 "flash_counts": {"zlib": True}})
+    # Write to a temporary name so a failed extraction never leaves a partial file that matches *.nc.
+    tmp_file = out_file + ".tmp"
+    patch_nc = _create_patch_file(tmp_file, bands, patch_x_length_pixels, patch_y_length_pixels, samples_per_time,
+                                  raw_counts=raw_counts)
+    try:
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                _write_patches(patch_nc, times,
+                               executor.map(extract_timestep, times, count_grids, time_seeds, chunksize=1),
+                               raw_counts)
+        else:
+            _write_patches(patch_nc, times, map(extract_timestep, times, count_grids, time_seeds), raw_counts)
+    except BaseException:
+        patch_nc.close()
+        remove(tmp_file)
+        raise
+    patch_nc.close()
+    replace(tmp_file, out_file)
+    glm_ds.close()
+    del glm_ds
     return 0
 
 
-def regrid_imagery(image, x_image, y_image, x_regrid, y_regrid, image_proj, regrid_proj, spline_kws=None):
+def _write_patches(patch_nc, times, timestep_results, raw_counts):
+    """
+    Append the patches extracted at each time step to an open patch file as they become available.
+
+    Args:
+        patch_nc (:class:`netCDF4.Dataset`): Patch file created by :func:`_create_patch_file`
+        times (:class:`pandas.DatetimeIndex`): Valid time of each GLM time step
+        timestep_results: Iterable of :func:`_extract_timestep_patches` results in time order
+        raw_counts (bool): Whether the patches are packed int16 radiance counts
+    """
+    num_patches = 0
+    file_packing = None
+    for time, timestep_result in zip(times, timestep_results):
+        if timestep_result is None:
+            continue
+        patches, patch_lons, patch_lats, flash_counts, rad_packing = timestep_result
+        if raw_counts:
+            # The file stores one packing per band, so every time step has to share it.
+            if file_packing is None:
+                file_packing = rad_packing
+                for var_name, packing in zip(["rad_scale_factor", "rad_add_offset", "rad_fill_value"], rad_packing):
+                    patch_nc[var_name][:] = packing
+            elif not all(np.array_equal(stored, current) for stored, current in zip(file_packing, rad_packing)):
+                raise ValueError("Radiance packing at {0} differs from earlier time steps. ".format(time) +
+                                 "Raw counts cannot be stored with a single packing per band.")
+        patch_slice = slice(num_patches, num_patches + patches.shape[0])
+        patch_nc["patch"][patch_slice] = np.arange(patch_slice.start, patch_slice.stop, dtype=np.int32)
+        patch_nc["abi"][patch_slice] = patches
+        patch_nc["time"][patch_slice] = (time - pd.Timestamp("1970-01-01")) // pd.Timedelta(seconds=1)
+        patch_nc["lon"][patch_slice] = patch_lons
+        patch_nc["lat"][patch_slice] = patch_lats
+        patch_nc["flash_counts"][patch_slice] = flash_counts
+        num_patches = patch_slice.stop
+
+
+def _create_patch_file(out_file, bands, patch_x_length_pixels, patch_y_length_pixels, samples_per_time,
+                       raw_counts=False):
+    """
+    Create a netCDF file for ABI patches with an unlimited patch dimension so that each time step
+    can be written as soon as it is extracted.
+
+    Args:
+        out_file (str): Path to the output netCDF file
+        bands (:class:`numpy.ndarray`, int): Array of band numbers
+        patch_x_length_pixels (int): Size of patch in x direction in pixels
+        patch_y_length_pixels (int): Size of patch in y direction in pixels
+        samples_per_time (int): Number of patches written per time step, used as the chunk size.
+        raw_counts (bool): Store abi as packed int16 radiance counts along with the per-band packing parameters.
+
+    Returns:
+        :class:`netCDF4.Dataset` open for writing
+    """
+    patch_nc = netCDF4.Dataset(out_file, "w")
+    patch_nc.createDimension("patch", None)
+    patch_nc.createDimension("band", bands.size)
+    patch_nc.createDimension("y", patch_y_length_pixels)
+    patch_nc.createDimension("x", patch_x_length_pixels)
+    patch_nc.createVariable("patch", "i4", ("patch",))
+    patch_nc.createVariable("band", "i4", ("band",))[:] = bands.astype(np.int32)
+    patch_nc.createVariable("y", "i4", ("y",))[:] = np.arange(patch_y_length_pixels, dtype=np.int32)
+    patch_nc.createVariable("x", "i4", ("x",))[:] = np.arange(patch_x_length_pixels, dtype=np.int32)
+    patch_nc.createVariable("abi", "i2" if raw_counts else "f4", ("patch", "band", "y", "x"), zlib=True,
+                            chunksizes=(samples_per_time, bands.size, patch_y_length_pixels, patch_x_length_pixels))
+    if raw_counts:
+        patch_nc.createVariable("rad_scale_factor", "f4", ("band",))
+        patch_nc.createVariable("rad_add_offset", "f4", ("band",))
+        patch_nc.createVariable("rad_fill_value", "i2", ("band",))
+    patch_time = patch_nc.createVariable("time", "i8", ("patch",))
+    patch_time.units = "seconds since 1970-01-01"
+    patch_time.calendar = "proleptic_gregorian"
+    for coord in ["lon", "lat"]:
+        patch_nc.createVariable(coord, "f4", ("patch", "y", "x"), zlib=True,
+                                chunksizes=(samples_per_time, patch_y_length_pixels, patch_x_length_pixels))
+    patch_nc.createVariable("flash_counts", "i4", ("patch",), zlib=True)
+    return patch_nc
+
+
+def _extract_timestep_patches(time, count_grid, seed, lons, lats, bands, abi_path, lead_time,
+                              patch_x_length_pixels, patch_y_length_pixels, samples_per_time, max_pos_counts,
+                              time_range_minutes, bt, raw=False):
     """
-    For a given image, regrid it to another projection using spline interpolation.
+    Sample grid points from a single GLM time step and extract the ABI patches centered on them.
+    Called by :func:`extract_abi_patches`, possibly in a worker process.
 
     Args:
-        image:
-        x_image:
-        y_image:
-        x_regrid:
-        y_regrid:
-        image_proj:
-        regrid_proj:
-        spline_kws:
+        time (:class:`pandas.Timestamp`): Valid time of the GLM grid
+        count_grid (:class:`numpy.ndarray`): Lightning counts on the GLM grid at this time
+        seed (:class:`numpy.random.SeedSequence`): Seed for sampling grid points at this time
+        lons (:class:`numpy.ndarray`): Longitudes of the GLM grid
+        lats (:class:`numpy.ndarray`): Latitudes of the GLM grid
+        bands (:class:`numpy.ndarray`, int): Array of band numbers
+        lead_time (str): Lead time in pandas Timedelta units
+        patch_x_length_pixels (int): Size of patch in x direction in pixels
+        patch_y_length_pixels (int): Size of patch in y direction in pixels
+        samples_per_time (int): Number of grid points to select without replacement
+        max_pos_counts (int): Maximum number of grid points with lightning to select
+        time_range_minutes (int): Minutes before or after time in which GOES16 files are valid.
+        bt (bool): Calculate brightness temperature instead of radiance
+        raw (bool): Extract packed int16 radiance counts
+
+    Returns:
+        patches, patch_lons, patch_lats, flash_counts for each sample and the radiance packing for each band,
+        or None if no ABI files were found.
+    """
+    print(time, flush=True)
+    rng = np.random.default_rng(seed)
+    patch_time = time - pd.Timedelta(lead_time)
+    has_lightning = count_grid > 0
+    pos_count = np.count_nonzero(has_lightning)
+    pos_sample_size = np.minimum(pos_count, max_pos_counts)
+    neg_sample_size = samples_per_time - pos_sample_size
+    # Generator.choice draws small samples without permuting the whole grid; shuffle=False only skips
+    # shuffling the drawn sample, whose order does not matter here.
+    if pos_sample_size > 0:
+        pos_time_samples = rng.choice(np.flatnonzero(has_lightning), size=pos_sample_size,
+                                      replace=False, shuffle=False)
+        neg_time_samples = rng.choice(np.flatnonzero(~has_lightning), size=neg_sample_size,
+                                      replace=False, shuffle=False)
+        time_samples = np.concatenate([pos_time_samples, neg_time_samples])
+    else:
+        time_samples = rng.choice(lons.size, size=samples_per_time, replace=False, shuffle=False)
+    sample_rows, sample_cols = np.unravel_index(time_samples, lons.shape)
+    try:
+        goes16_abi_timestep = GOES16ABI(patch_time, bands, abi_path, time_range_minutes=time_range_minutes)
+        patches, patch_lons, patch_lats = goes16_abi_timestep.extract_image_patches(lons[sample_rows, sample_cols],
+                                                                                    lats[sample_rows, sample_cols],
+                                                                                    patch_x_length_pixels,
+                                                                                    patch_y_length_pixels,
+                                                                                    bt=bt, raw=raw)
+        rad_packing = goes16_abi_timestep.rad_packing()
+        goes16_abi_timestep.close()
+        del goes16_abi_timestep
+    except FileNotFoundError as fnfe:
+        print(fnfe.args)
+        return None
+    flash_counts = count_grid[sample_rows, sample_cols]
+    return patches, patch_lons, patch_lats, flash_counts, rad_packing
 
+
+@lru_cache(maxsize=32)
+def _get_transformer(src_srs, dst_srs):
+    """
+    Create a pyproj Transformer between two projections. Cached by PROJ string so the coordinate
+    operation is only built once per pair of projections.
+
+    Args:
+        src_srs (str): PROJ string of the source projection
+        dst_srs (str): PROJ string of the destination projection
     Returns:
+        :class:`pyproj.Transformer`
+    """
+    return Transformer.from_proj(src_srs, dst_srs, always_xy=True)
 
+
+def regrid_imagery(image, x_image, y_image, x_regrid, y_regrid, image_proj, regrid_proj, map_kws=None):
+    """
+    For a given image, regrid it to another projection using spline interpolation. The image must be on a
+    regular grid, which allows the spline to be evaluated with :func:`scipy.ndimage.map_coordinates`.
+
+    Args:
+        image: 2D array indexed by (x, y)
+        x_image: evenly spaced x coordinates of the image
+        y_image: evenly spaced y coordinates of the image
+        x_regrid: x coordinates of the target grid
+        y_regrid: y coordinates of the target grid
+        image_proj: :class:`pyproj.Proj` of the image
+        regrid_proj: :class:`pyproj.Proj` of the target grid
+        map_kws: keyword arguments for :func:`scipy.ndimage.map_coordinates`. Defaults to cubic splines
+            with NaN outside the image.
+
+    Returns:
+        regridded image with the shape of x_regrid
     """
-    if spline_kws is None:
-        spline_kws = dict()
-    x_regrid_image, y_regrid_image = transform(image_proj, regrid_proj, x_regrid.ravel(), y_regrid.ravel())
-    rbs = RectBivariateSpline(x_image, y_image, image, **spline_kws)
-    regridded_image = rbs.ev(x_regrid_image, y_regrid_image).reshape(x_regrid.shape)
+    interp_kws = dict(order=3, mode="constant", cval=np.nan)
+    if map_kws is not None:
+        interp_kws.update(map_kws)
+    x_regrid_image, y_regrid_image = _get_transformer(image_proj.srs, regrid_proj.srs).transform(x_regrid.ravel(), y_regrid.ravel())
+    x_index = (x_regrid_image - x_image[0]) / (x_image[1] - x_image[0])
+    y_index = (y_regrid_image - y_image[0]) / (y_image[1] - y_image[0])
+    regridded_image = map_coordinates(image, [x_index, y_index], **interp_kws).reshape(x_regrid.shape)
     return regridded_image
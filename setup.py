@@ -14,6 +14,9 @@ if __name__ == "__main__":
                             "pandas",
                             "tensorflow>=1.15.2",
                             "xarray",
+                            "h5netcdf",
+                            "h5py",
+                            "netcdf4",
                             "dask",
                             "pyyaml",
                             "s3fs"]